@@ -4,14 +4,15 @@ Script for extracting volumes of interest (VOIs) from different aorta segments
 using a pre-segmented aorta mask
 """
 
+import warnings
 import numpy as np
 import nibabel as nib
+import cc3d
 from scipy.ndimage import (
-    center_of_mass, 
     label, 
-    uniform_filter, 
-    binary_dilation, 
-    median_filter
+    find_objects,
+    generate_binary_structure,
+    uniform_filter
 )
 from skimage.measure import regionprops
 from pathlib import Path
@@ -26,23 +27,26 @@ class AortaSegment(Enum):
     DESCENDING_BOTTOM = 4
 
 
-def count_connected_components(slice_2d):
-    """Count connected components in a 2D slice"""
-    labeled, num = label(slice_2d)
-    return num
-
-
 def count_axial_components(volume):
     """Count connected components along z-axis for each slice"""
-    return np.array([count_connected_components(volume[..., sl]) for sl in range(volume.shape[-1])])
+    # Label all slices in one call, with connectivity restricted to the axial plane
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[..., 1] = generate_binary_structure(2, 1)
+    labeled, _ = label(volume, structure=structure)
 
+    # Each component lies within a single slice, so count components per slice
+    slice_ixs = [obj[-1].start for obj in find_objects(labeled)]
+    return np.bincount(slice_ixs, minlength=volume.shape[-1])
 
-def find_pattern_transition(array, pattern):
+
+def find_pattern_transition(windows, pattern):
     """
-    Find index where pattern matches in array
+    Find index where pattern matches in a sliding window view of an array
     Returns the middle point of the transition
     """
-    indices = np.where(np.all(np.lib.stride_tricks.sliding_window_view(array, len(pattern)) == pattern, axis=1))[0]
+    if windows.shape[1] != len(pattern):
+        raise ValueError(f"Pattern length {len(pattern)} does not match window length {windows.shape[1]}")
+    indices = np.where(np.all(windows == pattern, axis=1))[0]
     if len(indices) != 1:
         raise ValueError(f"Expected 1 match, found {len(indices)}")
     
@@ -57,17 +61,22 @@ def find_aortic_segments_boundaries(aorta_volume):
     # Calculate transitions between different aortic segments
     islands = count_axial_components(aorta_volume)
     islands = np.minimum(islands, 2)  # Cap max islands at 2
-    islands = median_filter(islands, size=5)  # Smooth counts
+    # Smooth counts with a size 5 median filter (symmetric padding matches ndimage's default reflect mode)
+    islands = np.pad(islands, 2, mode='symmetric')
+    islands = np.median(np.lib.stride_tricks.sliding_window_view(islands, 5), axis=1).astype(int)
     
     # Find aortic transition points 1 -> 2 islands and 2->1 islands
-    ix_start = find_pattern_transition(islands, np.array([1, 1, 1, 1, 2, 2,2,2]))
-    ix_curve = find_pattern_transition(islands, np.array([2,2, 2, 2, 1, 1,1,1]))
+    start_pattern = np.array([1, 1, 1, 1, 2, 2,2,2])
+    curve_pattern = np.array([2,2, 2, 2, 1, 1,1,1])
+    windows = np.lib.stride_tricks.sliding_window_view(islands, len(start_pattern))
+    ix_start = find_pattern_transition(windows, start_pattern)
+    ix_curve = find_pattern_transition(windows, curve_pattern)
 
     return ix_start, ix_curve
 
 def maybe_fix_floaters(aorta):
     print("WARNING: Aorta is discontinuous, discarding smallest islands. Please inspect visually")
-    labeled, _ = label(aorta)
+    labeled = cc3d.connected_components(aorta, connectivity=6)
     if len(np.unique(labeled)) > 2:
         frequencies = np.bincount(labeled.flatten())
         #ignore background counts (ix=0)
@@ -82,32 +91,30 @@ def segment_aorta(aorta):
 
     ix_start, ix_curve = find_aortic_segments_boundaries(aorta)
     
-    # Process pre-curve region
-    aorta_seg = aorta.copy().astype(np.int64)
-    aorta_seg[..., ix_curve:] = 0
-    
-    # Label components and determine ascending/descending parts
-    labeled, _ = label(aorta_seg)
+    # Label components of the pre-curve region and determine ascending/descending parts
+    labeled = cc3d.connected_components(aorta[..., :ix_curve] > 0, connectivity=6)
     
     # Determine which label is ascending vs descending based on volume
-    if np.sum(labeled == 1) > np.sum(labeled == 2):
-        mapping = np.array([0, AortaSegment.DESCENDING.value, AortaSegment.ASCENDING.value])
+    voxel_counts = np.bincount(labeled.ravel(), minlength=3)
+    if voxel_counts[1] > voxel_counts[2]:
+        mapping = np.array([0, AortaSegment.DESCENDING.value, AortaSegment.ASCENDING.value], dtype=np.uint8)
     else:
-        mapping = np.array([0, AortaSegment.ASCENDING.value, AortaSegment.DESCENDING.value])
+        mapping = np.array([0, AortaSegment.ASCENDING.value, AortaSegment.DESCENDING.value], dtype=np.uint8)
     
-    aorta_seg = mapping[labeled]
+    aorta_seg = np.zeros(aorta.shape, dtype=np.uint8)
+    aorta_seg[..., :ix_curve] = mapping[labeled]
     
     # Mark top section
     aorta_seg[..., ix_curve:] = aorta[..., ix_curve:] * AortaSegment.TOP.value
     
-    # Mark descending bottom section
-    mask = (aorta_seg == AortaSegment.DESCENDING.value) & (np.arange(aorta.shape[-1]) < ix_start)[None, None, :]
-    aorta_seg[mask] = AortaSegment.DESCENDING_BOTTOM.value
+    # Mark descending bottom section, only the slab below ix_start is touched
+    aorta_bottom = aorta_seg[..., :ix_start]
+    aorta_bottom[aorta_bottom == AortaSegment.DESCENDING.value] = AortaSegment.DESCENDING_BOTTOM.value
 
-    return aorta_seg.astype(np.uint8)
+    return aorta_seg
 
 
-def create_cylindrical_voi(aorta_segment, pet, voxel_size, volume_ml=1.0, cylinder_width=3):
+def create_cylindrical_voi(aorta_segment, pet, voxel_size, volume_ml=1.0, cylinder_width=3, axial_axis=-1):
     """
     Create a cylindrical VOI inside the specified aorta segment
     
@@ -123,6 +130,8 @@ def create_cylindrical_voi(aorta_segment, pet, voxel_size, volume_ml=1.0, cylind
         Target volume in milliliters (default: 1.0)
     cylinder_width : int
         Width of the cylindrical cross-section (default: 3)
+    axial_axis : int
+        Axis along which the cylinder is placed (default: -1)
         
     Returns:
     --------
@@ -135,14 +144,22 @@ def create_cylindrical_voi(aorta_segment, pet, voxel_size, volume_ml=1.0, cylind
     
     # Create empty VOI
     voi = np.zeros_like(aorta_segment, dtype=bool)
+
+    # Work on views with the axial direction as the last axis
+    aorta_segment = np.moveaxis(aorta_segment, axial_axis, -1)
+    pet = np.moveaxis(pet, axial_axis, -1)
+    voi_axial = np.moveaxis(voi, axial_axis, -1)
     
     # Calculate required slices for target volume
     voxels_per_slice = cylinder_width**2
     n_slices_needed = max(1, int(np.ceil(target_voxels / voxels_per_slice)))
 
     # Find optimal placement based on PET uptake
-    pet_masked = np.ma.masked_array(data=pet, mask=~aorta_segment)
-    median_axial_uptake = np.ma.median(pet_masked, axis=(0,1)).filled(0)
+    with warnings.catch_warnings():
+        # Slices without any aorta voxels are all-NaN and get zero uptake
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median_axial_uptake = np.nanmedian(np.where(aorta_segment, pet, np.nan), axis=(0,1))
+    median_axial_uptake[np.isnan(median_axial_uptake)] = 0
     median_axial_uptake = uniform_filter(median_axial_uptake, n_slices_needed)
     
     #Ensure that the start_slice lies sufficiently in the middle of the aorta segment
@@ -155,16 +172,21 @@ def create_cylindrical_voi(aorta_segment, pet, voxel_size, volume_ml=1.0, cylind
 
     start_slice = np.argmax(median_axial_uptake) - n_slices_needed//2
 
-    # Place VOI seeds at center of mass for each slice
-    pet_masked = pet_masked.filled(0)
-    for slc in range(start_slice, start_slice+n_slices_needed):
-        x, y = center_of_mass(pet_masked[..., slc])
-        x, y = int(round(x)), int(round(y))
-        voi[x, y, slc] = True
-
-    # Create cylindrical shape by dilating the seed points
-    dilation_mask = np.ones((cylinder_width, cylinder_width, 1), dtype=bool)
-    voi = binary_dilation(voi, dilation_mask)
+    # Place VOI seeds at center of mass for each slice, only looking inside the segment bounding box
+    slcs = np.arange(start_slice, start_slice+n_slices_needed)
+    xs, ys, _ = find_objects(aorta_segment.astype(np.uint8))[0]
+    pet_masked = np.where(aorta_segment[xs, ys, slcs], pet[xs, ys, slcs], 0)
+    mass = pet_masked.sum(axis=(0,1))
+    if np.any(mass == 0):
+        raise ValueError(f"Cannot place the cylinder: slices {slcs[mass == 0].tolist()} contain no aorta segment uptake")
+    x = (pet_masked.sum(axis=1) * np.arange(xs.start, xs.stop)[:, None]).sum(axis=0) / mass
+    y = (pet_masked.sum(axis=0) * np.arange(ys.start, ys.stop)[:, None]).sum(axis=0) / mass
+
+    # Create cylindrical shape by stamping a square cross-section at each seed point
+    x0 = np.round(x).astype(int) - cylinder_width//2
+    y0 = np.round(y).astype(int) - cylinder_width//2
+    for x, y, slc in zip(x0, y0, slcs):
+        voi_axial[max(x, 0):x+cylinder_width, max(y, 0):y+cylinder_width, slc] = True
     
     # Calculate actual volume achieved
     actual_volume_ml = np.sum(voi) * voxel_volume / 1000
@@ -192,8 +214,13 @@ def average_early_pet_frames(dpet, frame_times_start, t_threshold=40):
         Averaged early PET frames
     """
     pet_arr = img_to_array_or_dataobj(dpet)
-    n_frames = np.sum(frame_times_start < t_threshold)
-    return pet_arr[..., :n_frames].mean(axis=-1)
+    n_frames = int(np.sum(frame_times_start < t_threshold))
+
+    # Read one frame at a time so only the early frames are loaded from disk
+    pet_sum = np.zeros(pet_arr.shape[:3], dtype=np.float32)
+    for i in range(n_frames):
+        pet_sum += np.asarray(pet_arr[..., i], dtype=np.float32)
+    return pet_sum / n_frames
 
 
 def refine_aorta_with_pet_uptake(aorta, pet):
@@ -202,10 +229,7 @@ def refine_aorta_with_pet_uptake(aorta, pet):
     Only keeps voxels with sufficient activity compared to median aorta uptake
     """
     pet_median_aorta = np.median(pet[aorta > 0])
-    activity_mask = pet > (2/3 * pet_median_aorta)
-    aorta_refined = aorta.copy()
-    aorta_refined[~activity_mask] = 0
-    return aorta_refined
+    return np.where(pet > (2/3 * pet_median_aorta), aorta, 0)
 
 def extract_aorta_segments(aorta_mask, pet):
     """
@@ -285,13 +309,10 @@ def extract_aorta_vois(aorta_segments, pet, volume_ml=1.0, cylinder_width=3,segm
     for seg in segs:
         aorta_segment = aorta_segments_arr == seg.value
         print("Extracting VOI for", seg.name)
-        if seg == AortaSegment.TOP:
-            voi = create_cylindrical_voi(aorta_segment.swapaxes(1,2), pet.swapaxes(1,2), voxel_size=voxel_size[[0,2,1]], 
-                                        volume_ml=volume_ml, cylinder_width=cylinder_width)
-            voi = voi.swapaxes(1,2)
-        else:
-            voi = create_cylindrical_voi(aorta_segment, pet, voxel_size=voxel_size, 
-                                        volume_ml=volume_ml, cylinder_width=cylinder_width)
+        # The top of the aortic arch runs along the second axis
+        axial_axis = 1 if seg == AortaSegment.TOP else -1
+        voi = create_cylindrical_voi(aorta_segment, pet, voxel_size=voxel_size, 
+                                    volume_ml=volume_ml, cylinder_width=cylinder_width, axial_axis=axial_axis)
         vois[voi] = seg.value
 
 
@@ -1,12 +1,14 @@
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
 from scipy.integrate import cumulative_simpson
-from sklearn.linear_model import LinearRegression
+from numba import njit, prange
 from .utils import OverlappedChunkIterator, img_to_array_or_dataobj
 
 def roi_patlak(roi_tac,if_tac,t,n_frames_linear_regression):
-    slopes, intercepts = _voxel_patlak_chunk(roi_tac,if_tac,t,n_frames_linear_regression=n_frames_linear_regression)
+    slopes, intercepts = _voxel_patlak_chunk(roi_tac,*_patlak_regressor(if_tac,t,n_frames_linear_regression))
     
     with np.errstate(divide='ignore',invalid='ignore'):
         _X = cumulative_simpson(if_tac,x=t/60,initial=0) / if_tac
@@ -19,25 +21,54 @@ def roi_patlak(roi_tac,if_tac,t,n_frames_linear_regression):
     return slopes, intercepts, X, Y
 
 
-def _voxel_patlak_chunk(arr,input_fun,t,n_frames_linear_regression=10):
+def _patlak_regressor(input_fun,t,n_frames_linear_regression=10):
     
     # Normalized cumsum AIF
     with np.errstate(divide='ignore',invalid='ignore'):
         _X = cumulative_simpson(input_fun,x=t/60,initial=0) / input_fun
-        X = _X[-n_frames_linear_regression:].reshape(-1,1)
+        X = _X[-n_frames_linear_regression:]
+
+    # Moments of X, shared by all voxel fits
+    xm = X.mean()
+    X_centered = X - xm
+    Sxx = X_centered @ X_centered
+    input_fun_tail = np.asarray(input_fun[-n_frames_linear_regression:], dtype=np.float64)
+
+    return input_fun_tail, X_centered, xm, Sxx
+
+
+def _voxel_patlak_chunk(arr,input_fun_tail,X_centered,xm,Sxx):
 
     # Normalized voxel response
-    Y = arr.reshape(-1, arr.shape[-1]).T[-n_frames_linear_regression:]
-    Y = Y/input_fun[-n_frames_linear_regression:,None]
+    Y = arr.reshape(-1, arr.shape[-1]).T[-len(input_fun_tail):]
+    Y = Y/input_fun_tail[:,None]
 
-    #Linear regression
-    reg = LinearRegression().fit(X, Y)
-    slopes = reg.coef_.reshape(arr.shape[:-1])
-    intercepts = reg.intercept_.reshape(arr.shape[:-1])
+    #Linear regression (closed-form least squares, X is shared by all voxels)
+    slopes = (X_centered @ Y) / Sxx
+    intercepts = Y.mean(axis=0) - slopes * xm
+    slopes = slopes.reshape(arr.shape[:-1])
+    intercepts = intercepts.reshape(arr.shape[:-1])
 
     return slopes, intercepts
 
-def voxel_patlak(img, input_fun, t, gaussian_filter_size=0, n_frames_linear_regression=10, axial_chunk_size=8):
+@njit(parallel=True, fastmath=True, cache=True)
+def _patlak_kernel(chunk, input_fun_tail, X_centered, xm, Sxx, out_slopes, out_intercepts):
+    # Closed-form least squares per voxel, written directly into the output views
+    H, W, D, n = chunk.shape
+    for i in prange(H):
+        for j in range(W):
+            for k in range(D):
+                y_sum = 0.0
+                Sxy = 0.0
+                for f in range(n):
+                    y = chunk[i, j, k, f] / input_fun_tail[f]
+                    y_sum += y
+                    Sxy += X_centered[f] * y
+                slope = Sxy / Sxx
+                out_slopes[i, j, k] = slope
+                out_intercepts[i, j, k] = y_sum / n - slope * xm
+
+def voxel_patlak(img, input_fun, t, gaussian_filter_size=0, n_frames_linear_regression=10, axial_chunk_size=8, max_workers=4):
     """
     Process image data in overlapping chunks, applying Gaussian smoothing and keeping only valid center portions.
     
@@ -48,11 +79,23 @@ def voxel_patlak(img, input_fun, t, gaussian_filter_size=0, n_frames_linear_regr
         gaussian_std: Standard deviation for Gaussian smoothing (default: 0)
         n_frames_linear_regression: Number of frames for linear regression (default: 10)
         axial_chunk_size: Size of axial chunks to process (default: 8)
+        max_workers: Maximum number of chunks held in memory at once while being read, filtered or fitted.
+            This bounds memory use rather than following the CPU count (default: 4)
     """
     img = img_to_array_or_dataobj(img)
-    out = np.zeros(img.shape[:-1])
-    out_intercepts = np.zeros(img.shape[:-1])
+    out = np.zeros(img.shape[:-1], dtype=np.float32)
+    out_intercepts = np.zeros(img.shape[:-1], dtype=np.float32)
     border_size = 3 * gaussian_filter_size if gaussian_filter_size > 0 else 0
+
+    # Regressor is computed once and shared by all chunks
+    input_fun_tail, X_centered, xm, Sxx = _patlak_regressor(input_fun, t, n_frames_linear_regression)
+
+    # The kernel does not bounds check, so the AIF must cover the same frames as the image
+    n_frames = min(n_frames_linear_regression, img.shape[-1])
+    if len(input_fun_tail) != n_frames:
+        raise ValueError(f"Input function provides {len(input_fun_tail)} frames for linear regression, but the image provides {n_frames}")
+    input_fun_tail = input_fun_tail.astype(np.float32)
+    X_centered = X_centered.astype(np.float32)
     
     # Create iterator for overlapped chunks
     chunk_iterator = OverlappedChunkIterator(
@@ -61,21 +104,43 @@ def voxel_patlak(img, input_fun, t, gaussian_filter_size=0, n_frames_linear_regr
         border_size=border_size
     )
 
-    # Process each chunk
-    for start_idx, end_idx, valid_start, valid_end, out_start, out_size in tqdm(chunk_iterator):
-        # Extract and process chunk
-        chunk = img[..., start_idx:end_idx, -n_frames_linear_regression:]
+    def load_chunk(chunk_info):
+        start_idx, end_idx, valid_start, valid_end, out_start, out_size = chunk_info
+
+        # Extract chunk as a private float32 copy, PET intensities do not need double precision
+        chunk = np.array(img[..., start_idx:end_idx, -n_frames_linear_regression:], dtype=np.float32)
+
+        # Empty chunks (e.g. air) fit to zero slopes and intercepts, which the output already holds
+        if not chunk.any():
+            return None
         
-        # Apply Gaussian filter if needed
+        # Apply Gaussian filter if needed, one spatial axis at a time in place
         if gaussian_filter_size > 0:
-            chunk = gaussian_filter(chunk, sigma=[gaussian_filter_size, gaussian_filter_size, gaussian_filter_size, 0])
+            for axis in range(3):
+                gaussian_filter1d(chunk, gaussian_filter_size, axis=axis, output=chunk)
         
-        # Process only the valid portion
-        valid_chunk = chunk[..., valid_start:valid_end, :]
-        slopes, intercepts = _voxel_patlak_chunk(valid_chunk, input_fun, t, n_frames_linear_regression)
-        
-        # Store results
-        out[..., out_start:out_start + out_size] = slopes
-        out_intercepts[..., out_start:out_start + out_size] = intercepts
+        # Keep only the valid portion
+        return chunk[..., valid_start:valid_end, :], out_start, out_size
+
+    def fit_chunk(future):
+        # The kernel is parallel itself and is only launched from this thread
+        result = future.result()
+        if result is not None:
+            valid_chunk, out_start, out_size = result
+            _patlak_kernel(valid_chunk, input_fun_tail, X_centered, xm, Sxx,
+                           out[..., out_start:out_start + out_size],
+                           out_intercepts[..., out_start:out_start + out_size])
+        progress.update()
+
+    # Read and filter chunks in worker threads while earlier chunks are fitted,
+    # keeping at most max_workers chunks in flight (including the one being fitted)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(chunk_iterator)) as progress:
+        pending = deque()
+        for chunk_info in chunk_iterator:
+            pending.append(executor.submit(load_chunk, chunk_info))
+            if len(pending) >= max_workers:
+                fit_chunk(pending.popleft())
+        while pending:
+            fit_chunk(pending.popleft())
         
     return out, out_intercepts
\ No newline at end of file